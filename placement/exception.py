@@ -11,12 +11,33 @@
 #    under the License.
 """Exceptions for use in the Placement API."""
 
+import re
+
 from oslo_log import log as logging
+import six
 
 
 LOG = logging.getLogger(__name__)
 
+_FMT_KEY_RE = re.compile(r'%\((\w+)\)')
+
+
+class _BaseExceptionMeta(type):
+    """Metaclass computing class-invariant details of 'msg_fmt' once, when
+    each exception class is defined, rather than on every instantiation.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(_BaseExceptionMeta, cls).__init__(name, bases, attrs)
+        # A msg_fmt without any '%' renders to itself whatever the kwargs, so
+        # there is no need to format it.
+        cls._has_fmt_args = '%' in cls.msg_fmt
+        # The keys msg_fmt expects to find in the kwargs given to the
+        # constructor.
+        cls._fmt_keys = frozenset(_FMT_KEY_RE.findall(cls.msg_fmt))
+
 
+@six.add_metaclass(_BaseExceptionMeta)
 class _BaseException(Exception):
     """Base Exception
 
@@ -29,30 +50,80 @@ class _BaseException(Exception):
 
     def __init__(self, message=None, **kwargs):
         self.kwargs = kwargs
-
-        if not message:
-            try:
-                message = self.msg_fmt % kwargs
-            except Exception:
-                # NOTE(melwitt): This is done in a separate method so it can be
-                # monkey-patched during testing to make it a hard failure.
-                self._log_exception()
-                message = self.msg_fmt
-
-        self.message = message
-        super(_BaseException, self).__init__(message)
+        # The message is only rendered from msg_fmt when it is first asked
+        # for (see format_message), so exceptions which are raised and caught
+        # internally, like ResourceProviderNotFound, never pay for it.
+        self._message = message or None
+        super(_BaseException, self).__init__()
+        # Checking that the kwargs match msg_fmt is cheap though, so a bad
+        # raise is still reported where it happens, and msg_fmt is used as
+        # the message.
+        if (not message and self._has_fmt_args and
+                not self._fmt_keys.issubset(kwargs)):
+            self._log_exception()
+            self._message = self.msg_fmt
+
+    def __reduce__(self):
+        # The default pickling of exceptions recreates them from the args
+        # that were set, which are empty unless something set them, so pass
+        # the message along to skip the kwargs check in __init__.
+        state = {'kwargs': self.kwargs}
+        args = super(_BaseException, self).args
+        if args:
+            state['args'] = args
+        return (self.__class__, (self.format_message(),), state)
+
+    # Unless they are set, the args of the exception are the message,
+    # rendered when they are first read.
+    @property
+    def args(self):
+        args = super(_BaseException, self).args
+        if args:
+            return args
+        return (self.format_message(),)
+
+    @args.setter
+    def args(self, value):
+        Exception.args.__set__(self, value)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(repr(arg) for arg in self.args))
+
+    def __str__(self):
+        return self.format_message()
+
+    __unicode__ = __str__
+
+    @property
+    def message(self):
+        return self.format_message()
 
     def _log_exception(self):
         # kwargs doesn't match a variable in the message
         # log the issue and the kwargs
-        LOG.exception('Exception in string format operation')
-        for name, value in self.kwargs.items():
-            LOG.error("%s: %s" % (name, value))  # noqa
+        # NOTE(melwitt): This is done in a separate method so it can be
+        # monkey-patched during testing to make it a hard failure.
+        LOG.error('Exception in string format operation for %s, kwargs: %s',
+                  self.__class__.__name__, self.kwargs)
+
+    def _render_message(self):
+        if not self._has_fmt_args:
+            return self.msg_fmt
+        try:
+            # NOTE: printf style formatting with a dict is faster than
+            # str.format_map() on an equivalent '{key}' template, so
+            # msg_fmt is used as is.
+            return self.msg_fmt % self.kwargs
+        except Exception:
+            # A value doesn't match its conversion, e.g. a str for %d.
+            self._log_exception()
+            return self.msg_fmt
 
     def format_message(self):
-        # Use the first argument to the python Exception object which
-        # should be our full exception message, (see __init__).
-        return self.args[0]
+        if self._message is None:
+            self._message = self._render_message()
+        return self._message
 
 
 class NotFound(_BaseException):
@@ -102,16 +173,16 @@ class InvalidAllocationConstraintsViolated(InvalidInventory):
                "amount would violate inventory constraints.")
 
 
+# The comparison is "greater than or equal to" before microversion 1.26 and
+# "greater than" from 1.26 on, where reserved may be equal to total.
 class InvalidInventoryCapacity(InvalidInventory):
     msg_fmt = ("Invalid inventory for '%(resource_class)s' on "
                "resource provider '%(resource_provider)s'. "
-               "The reserved value is greater than or equal to total.")
-
+               "The reserved value is %(comparison)s total.")
 
-class InvalidInventoryCapacityReservedCanBeTotal(InvalidInventoryCapacity):
-    msg_fmt = ("Invalid inventory for '%(resource_class)s' on "
-               "resource provider '%(resource_provider)s'. "
-               "The reserved value is greater than total.")
+    def __init__(self, message=None, **kwargs):
+        kwargs.setdefault('comparison', 'greater than or equal to')
+        super(InvalidInventoryCapacity, self).__init__(message, **kwargs)
 
 
 # An exception with this name is used on both sides of the placement/
@@ -155,24 +155,24 @@ def _validate_inventory_capacity(version, inventories):
     :param version: request microversion.
     :param inventories: One Inventory or a list of Inventory objects to
                         validate capacities of.
-    :raises: exception.InvalidInventoryCapacityReservedCanBeTotal if request
-        microversion is 1.26 or higher and any inventory has capacity < 0.
-    :raises: exception.InvalidInventoryCapacity if request
+    :raises: exception.InvalidInventoryCapacity if request microversion is
+        1.26 or higher and any inventory has capacity < 0, or if request
         microversion is lower than 1.26 and any inventory has capacity <= 0.
     """
     if not version.matches((1, 26)):
         op = operator.le
-        exc_class = exception.InvalidInventoryCapacity
+        comparison = 'greater than or equal to'
     else:
         op = operator.lt
-        exc_class = exception.InvalidInventoryCapacityReservedCanBeTotal
+        comparison = 'greater than'
     if isinstance(inventories, inv_obj.Inventory):
         inventories = [inventories]
     for inventory in inventories:
         if op(inventory.capacity, 0):
-            raise exc_class(
+            raise exception.InvalidInventoryCapacity(
                 resource_class=inventory.resource_class,
-                resource_provider=inventory.resource_provider.uuid)
+                resource_provider=inventory.resource_provider.uuid,
+                comparison=comparison)
 
 
 @wsgi_wrapper.PlacementWsgify
@@ -11,10 +11,8 @@
 #    under the License.
 
 import collections
-import copy
 import itertools
 
-import os_traits
 from oslo_log import log as logging
 from oslo_utils import encodeutils
 import six
@@ -33,6 +31,7 @@ from placement import resource_class_cache as rc_cache
 _ALLOC_TBL = models.Allocation.__table__
 _INV_TBL = models.Inventory.__table__
 _RP_TBL = models.ResourceProvider.__table__
+_RC_TBL = models.ResourceClass.__table__
 
 LOG = logging.getLogger(__name__)
 
@@ -83,17 +82,20 @@ class AllocationCandidates(object):
         )
 
     @staticmethod
-    def _get_by_one_request(rg_ctx, rw_ctx):
-        """Get allocation candidates for one RequestGroup.
+    def _get_rps_by_one_request(rg_ctx, rw_ctx):
+        """Get the resource providers which can satisfy one RequestGroup.
 
         Must be called from within an placement_context_manager.reader
         (or writer) context.
 
         :param rg_ctx: RequestGroupSearchContext.
         :param rw_ctx: RequestWideSearchContext.
+        :return: A tuple of (providers, root provider IDs), where providers
+                 is to be passed to _get_by_one_request() for the same
+                 RequestGroup and root provider IDs is a set of internal IDs
+                 of the roots of all the trees those providers are in.
         """
-        if not rg_ctx.use_same_provider and (
-                rg_ctx.exists_sharing or rg_ctx.exists_nested):
+        if _use_multiple_providers(rg_ctx):
             # TODO(jaypipes): The check/callout to handle trees goes here.
             # Build a dict, keyed by resource class internal ID, of lists of
             # internal IDs of resource providers that share some inventory for
@@ -108,9 +110,12 @@ class AllocationCandidates(object):
                 trait_rps = res_ctx.get_provider_ids_having_any_trait(
                     rg_ctx.context, rg_ctx.required_trait_map)
                 if not trait_rps:
-                    return [], []
+                    return None, set()
             rp_candidates = res_ctx.get_trees_matching_all(rg_ctx, rw_ctx)
-            return _alloc_candidates_multiple_providers(rg_ctx, rp_candidates)
+            # We should include the providers themselves because while
+            # sharing providers are root providers, they have their "anchor"
+            # providers as the root IDs in the candidates.
+            return rp_candidates, rp_candidates.all_rps
 
         # Either we are processing a single-RP request group, or there are no
         # sharing providers that (help) satisfy the request.  Get a list of
@@ -118,7 +123,28 @@ class AllocationCandidates(object):
         # the requested resources and more efficiently construct the
         # allocation requests.
         rp_tuples = res_ctx.get_provider_ids_matching(rg_ctx)
-        return _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples)
+        return rp_tuples, {p[1] for p in rp_tuples}
+
+    @staticmethod
+    def _get_by_one_request(rg_ctx, rw_ctx, rps, summaries):
+        """Get allocation candidates for one RequestGroup.
+
+        Must be called from within an placement_context_manager.reader
+        (or writer) context.
+
+        :param rg_ctx: RequestGroupSearchContext.
+        :param rw_ctx: RequestWideSearchContext.
+        :param rps: The providers returned by _get_rps_by_one_request() for
+                    this RequestGroup.
+        :param summaries: dict, keyed by resource provider id, of
+                          ProviderSummary objects for all the providers in
+                          the trees involved in the overall request.
+        """
+        if _use_multiple_providers(rg_ctx):
+            return _alloc_candidates_multiple_providers(
+                rg_ctx, rps, summaries)
+        return _alloc_candidates_single_provider(
+            rg_ctx, rw_ctx, rps, summaries)
 
     @classmethod
     @db_api.placement_context_manager.reader
@@ -131,14 +157,33 @@ class AllocationCandidates(object):
         #  Unclear whether this would be cheaper than waiting until we've
         #  filtered sharing providers for other things (like resources).
 
-        candidates = {}
+        # First find the providers for each RequestGroup, so that usages,
+        # traits and provider information for all the trees involved are
+        # then fetched in one go rather than once per RequestGroup.
+        rps_by_suffix = {}
+        root_ids = set()
         for suffix, group in groups.items():
             rg_ctx = res_ctx.RequestGroupSearchContext(
                 context, group, rw_ctx.has_trees, sharing, suffix)
+            rps, rg_root_ids = cls._get_rps_by_one_request(rg_ctx, rw_ctx)
+            if not rg_root_ids:
+                LOG.debug("%s (suffix '%s') returned no providers",
+                          group, suffix)
+                # Shortcut: If any one group resulted in no candidates, the
+                # whole operation is shot.
+                return [], []
+            rps_by_suffix[suffix] = rg_ctx, rps
+            root_ids |= rg_root_ids
+
+        summaries = _get_provider_summaries(context, root_ids)
 
-            alloc_reqs, summaries = cls._get_by_one_request(rg_ctx, rw_ctx)
+        candidates = {}
+        for suffix, group in groups.items():
+            rg_ctx, rps = rps_by_suffix[suffix]
+            alloc_reqs = cls._get_by_one_request(
+                rg_ctx, rw_ctx, rps, summaries)
             LOG.debug("%s (suffix '%s') returned %d matches",
-                      str(group), str(suffix), len(alloc_reqs))
+                      group, suffix, len(alloc_reqs))
             if not alloc_reqs:
                 # Shortcut: If any one group resulted in no candidates, the
                 # whole operation is shot.
@@ -148,15 +193,15 @@ class AllocationCandidates(object):
             # single provider.  We'll need this later to evaluate group_policy.
             for areq in alloc_reqs:
                 areq.use_same_provider = group.use_same_provider
-            candidates[suffix] = alloc_reqs, summaries
+            candidates[suffix] = alloc_reqs
 
-        # At this point, each (alloc_requests, summary_obj) in `candidates` is
+        # At this point, each list of alloc_requests in `candidates` is
         # independent of the others. We need to fold them together such that
         # each allocation request satisfies *all* the incoming `requests`.  The
         # `candidates` dict is guaranteed to contain entries for all suffixes,
         # or we would have short-circuited above.
         alloc_request_objs, summary_objs = _merge_candidates(
-            candidates, rw_ctx)
+            candidates, list(summaries.values()), rw_ctx)
 
         alloc_request_objs, summary_objs = rw_ctx.exclude_nested_providers(
             alloc_request_objs, summary_objs)
@@ -166,6 +211,13 @@ class AllocationCandidates(object):
 
 class AllocationRequest(object):
 
+    # There are as many AllocationRequest, AllocationRequestResource,
+    # ProviderSummary and ProviderSummaryResource objects as there are
+    # allocation candidates and providers involved, so keep their attributes
+    # out of a per-instance __dict__.
+    __slots__ = ('anchor_root_provider_uuid', 'use_same_provider',
+                 'resource_requests', 'mappings', '_resource_requests_set')
+
     def __init__(self, anchor_root_provider_uuid=None,
                  use_same_provider=None, resource_requests=None,
                  mappings=None):
@@ -182,6 +234,10 @@ class AllocationRequest(object):
         # mappings will be presented as a dict during output, so ensure we have
         # a reasonable default here, despite mappings always being set.
         self.mappings = mappings or dict()
+        # The resource requests as a frozenset, computed when first needed to
+        # compare or hash this AllocationRequest. resource_requests must not
+        # be changed after that.
+        self._resource_requests_set = None
 
     def __repr__(self):
         anchor = (self.anchor_root_provider_uuid[-8:]
@@ -196,21 +252,29 @@ class AllocationRequest(object):
             repr_str = encodeutils.safe_encode(repr_str, incoming='utf-8')
         return repr_str
 
+    def _get_resource_requests_set(self):
+        if self._resource_requests_set is None:
+            self._resource_requests_set = frozenset(self.resource_requests)
+        return self._resource_requests_set
+
     def __eq__(self, other):
-        return (set(self.resource_requests) == set(other.resource_requests)
-                and self.mappings == other.mappings)
+        return (self._get_resource_requests_set() ==
+                other._get_resource_requests_set() and
+                self.mappings == other.mappings)
 
     def __hash__(self):
-        # We need a stable sort order on the resource requests to get an
-        # accurate hash. To avoid needing to update the method everytime
-        # the structure of an AllocationRequestResource changes, we can
-        # sort on the hash of each request resource.
-        sorted_rr = sorted(self.resource_requests, key=lambda x: hash(x))
-        return hash(tuple(sorted_rr))
+        # The order of the resource requests doesn't matter, so hash them as
+        # a frozenset, whose hash is also cached by the frozenset itself. To
+        # avoid needing to update the method everytime the structure of an
+        # AllocationRequestResource changes, we rely on the hash of each
+        # request resource.
+        return hash(self._get_resource_requests_set())
 
 
 class AllocationRequestResource(object):
 
+    __slots__ = ('resource_provider', 'resource_class', 'amount')
+
     def __init__(self, resource_provider=None, resource_class=None,
                  amount=None):
         self.resource_provider = resource_provider
@@ -230,6 +294,8 @@ class AllocationRequestResource(object):
 
 class ProviderSummary(object):
 
+    __slots__ = ('resource_provider', 'resources', 'traits')
+
     def __init__(self, resource_provider=None, resources=None, traits=None):
         self.resource_provider = resource_provider
         self.resources = resources or []
@@ -238,6 +304,8 @@ class ProviderSummary(object):
 
 class ProviderSummaryResource(object):
 
+    __slots__ = ('resource_class', 'capacity', 'used', 'max_unit')
+
     def __init__(self, resource_class=None, capacity=None, used=None,
                  max_unit=None):
         self.resource_class = resource_class
@@ -248,12 +316,28 @@ class ProviderSummaryResource(object):
         self.max_unit = max_unit
 
 
-def _alloc_candidates_multiple_providers(rg_ctx, rp_candidates):
-    """Returns a tuple of (allocation requests, provider summaries) for a
-    supplied set of requested resource amounts and tuples of
-    (rp_id, root_id, rc_id). The supplied resource provider trees have
-    capacity to satisfy ALL of the resources in the requested resources as
-    well as ALL required traits that were requested by the user.
+def _list_dd():
+    """Returns a defaultdict of lists, for use as the default factory of
+    another defaultdict.
+    """
+    return collections.defaultdict(list)
+
+
+def _use_multiple_providers(rg_ctx):
+    """Returns True if the RequestGroup may be satisfied by multiple
+    providers in a tree and/or sharing providers, False if it has to be
+    satisfied by a single provider.
+    """
+    return not rg_ctx.use_same_provider and (
+        rg_ctx.exists_sharing or rg_ctx.exists_nested)
+
+
+def _alloc_candidates_multiple_providers(rg_ctx, rp_candidates, summaries):
+    """Returns a list of allocation requests for a supplied set of requested
+    resource amounts and tuples of (rp_id, root_id, rc_id). The supplied
+    resource provider trees have capacity to satisfy ALL of the resources in
+    the requested resources as well as ALL required traits that were
+    requested by the user.
 
     This is a code path to get results for a RequestGroup with
     use_same_provider=False. In this scenario, we are able to use multiple
@@ -263,43 +347,59 @@ def _alloc_candidates_multiple_providers(rg_ctx, rp_candidates):
     :param rg_ctx: RequestGroupSearchContext.
     :param rp_candidates: RPCandidates object representing the providers
                           that satisfy the request for resources.
+    :param summaries: dict, keyed by resource provider id, of ProviderSummary
+                      objects containing usage and trait information for
+                      resource providers involved in the overall request
     """
     if not rp_candidates:
-        return [], []
-
-    # Get all the root resource provider IDs. We should include the first
-    # values of rp_tuples because while sharing providers are root providers,
-    # they have their "anchor" providers for the second value.
-    root_ids = rp_candidates.all_rps
-
-    # Grab usage summaries for each provider in the trees
-    usages = _get_usages_by_provider_tree(rg_ctx.context, root_ids)
-
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
+        return []
 
-    # Get a dict, keyed by resource provider internal ID, of ProviderSummary
-    # objects for all providers
-    summaries = _build_provider_summaries(rg_ctx.context, usages, prov_traits)
+    # Look up the names of the requested resource classes once rather than
+    # for every candidate
+    rc_names = {rc_id: rc_cache.RC_CACHE.string_from_id(rc_id)
+                for rc_id in rg_ctx.resources}
 
     # Get a dict, keyed by root provider internal ID, of a dict, keyed by
     # resource class internal ID, of lists of AllocationRequestResource objects
-    tree_dict = collections.defaultdict(lambda: collections.defaultdict(list))
+    tree_dict = collections.defaultdict(_list_dd)
 
     for rp in rp_candidates.rps_info:
         rp_summary = summaries[rp.id]
         tree_dict[rp.root_id][rp.rc_id].append(
             AllocationRequestResource(
                 resource_provider=rp_summary.resource_provider,
-                resource_class=rc_cache.RC_CACHE.string_from_id(rp.rc_id),
+                resource_class=rc_names[rp.rc_id],
                 amount=rg_ctx.resources[rp.rc_id]))
 
-    # Next, build up a set of allocation requests. These allocation requests
+    # Give each required trait a bit, and get a dict, keyed by resource
+    # provider internal ID, of the bits of the required traits the provider
+    # has, so that the traits of combinations of providers are checked with
+    # bitwise operations. Other traits don't matter here.
+    trait_bits = {}
+    bits_by_rp = {}
+    if rg_ctx.required_trait_map:
+        trait_bits = {name: 1 << i for i, name in
+                      enumerate(rg_ctx.required_trait_map)}
+        for rp_id in rp_candidates.rps:
+            bits = 0
+            for trait in summaries[rp_id].traits:
+                bits |= trait_bits.get(trait, 0)
+            bits_by_rp[rp_id] = bits
+
+    # Next, build up a list of allocation requests. These allocation requests
     # are AllocationRequest objects, containing resource provider UUIDs,
     # resource class names and amounts to consume from that resource provider
-    alloc_requests = set()
+    alloc_requests = []
+    # The combinations of providers we've already got allocation requests
+    # for. The combinations within a tree are all different, but trees
+    # sharing the same sharing providers may produce the same combination,
+    # which we want only once. Since request_groups are ordered by resource
+    # class for every tree, the tuple of the provider IDs identifies the
+    # combination.
+    seen = set()
+    # All the trees have to provide the same resource classes, so sort them
+    # once for all the trees.
+    sorted_rc_ids = sorted(rg_ctx.resources)
 
     # Let's look into each tree
     for root_id, alloc_dict in tree_dict.items():
@@ -314,75 +414,78 @@ def _alloc_candidates_multiple_providers(rg_ctx, rp_candidates):
         #  [ARR(rc2, rp1), ARR(rc2, rp2)],
         #  [ARR(rc3, rp1)]]
         # , which should be ordered by the resource class id.
-        request_groups = [val for key, val in sorted(alloc_dict.items())]
+        if len(alloc_dict) != len(rg_ctx.resources):
+            # This tree can't provide all the requested resources, so there
+            # is no combination to look for.
+            continue
+        request_groups = [alloc_dict[rc_id] for rc_id in sorted_rc_ids]
 
         root_summary = summaries[root_id]
         root_uuid = root_summary.resource_provider.uuid
-        root_alloc_reqs = set()
 
-        # Using itertools.product, we get all the combinations of resource
-        # providers in a tree.
+        # Using _product_with_traits, we get all the combinations of
+        # resource providers in a tree which collectively have the required
+        # traits.
         # For example, the sample in the comment above becomes:
         # [(ARR(rc1, ss1), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss1), ARR(rc2, ss2), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss2), ARR(rc3, ss1))]
-        for res_requests in itertools.product(*request_groups):
-            if not _check_traits_for_alloc_request(
-                    res_requests, summaries,
-                    rg_ctx.required_trait_map,
-                    rg_ctx.forbidden_trait_map):
-                # This combination doesn't satisfy trait constraints
+        for res_requests in _product_with_traits(
+                request_groups, bits_by_rp, trait_bits):
+            key = tuple(rr.resource_provider.id for rr in res_requests)
+            if key in seen:
                 continue
-
-            mappings = collections.defaultdict(set)
-            for rr in res_requests:
-                mappings[rg_ctx.suffix].add(rr.resource_provider.uuid)
+            seen.add(key)
+            mappings = {rg_ctx.suffix: {
+                rr.resource_provider.uuid for rr in res_requests}}
             alloc_req = AllocationRequest(resource_requests=list(res_requests),
                                           anchor_root_provider_uuid=root_uuid,
                                           mappings=mappings)
-            root_alloc_reqs.add(alloc_req)
-        alloc_requests |= root_alloc_reqs
-    return list(alloc_requests), list(summaries.values())
+            alloc_requests.append(alloc_req)
+    return alloc_requests
 
 
-def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
-    """Returns a tuple of (allocation requests, provider summaries) for a
-    supplied set of requested resource amounts and resource providers. The
-    supplied resource providers have capacity to satisfy ALL of the resources
-    in the requested resources as well as ALL required traits that were
-    requested by the user.
+def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples, summaries):
+    """Returns a list of allocation requests for a supplied set of requested
+    resource amounts and resource providers. The supplied resource providers
+    have capacity to satisfy ALL of the resources in the requested resources
+    as well as ALL required traits that were requested by the user.
 
     This is used in two circumstances:
     - To get results for a RequestGroup with use_same_provider=True.
     - As an optimization when no sharing providers satisfy any of the requested
       resources, and nested providers are not in play.
     In these scenarios, we can more efficiently build the list of
-    AllocationRequest and ProviderSummary objects due to not having to
-    determine requests across multiple providers.
+    AllocationRequest objects due to not having to determine requests across
+    multiple providers.
 
     :param rg_ctx: RequestGroupSearchContext
     :param rw_ctx: RequestWideSearchContext
     :param rp_tuples: List of two-tuples of (provider ID, root provider ID)s
                       for providers that matched the requested resources
+    :param summaries: dict, keyed by resource provider id, of ProviderSummary
+                      objects containing usage and trait information for
+                      resource providers involved in the overall request
     """
     if not rp_tuples:
-        return [], []
-
-    # Get all root resource provider IDs.
-    root_ids = set(p[1] for p in rp_tuples)
-
-    # Grab usage summaries for each provider
-    usages = _get_usages_by_provider_tree(rg_ctx.context, root_ids)
-
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
+        return []
 
-    # Get a dict, keyed by resource provider internal ID, of ProviderSummary
-    # objects for all providers
-    summaries = _build_provider_summaries(rg_ctx.context, usages, prov_traits)
+    # Look up the names of the requested resource classes once rather than
+    # for every provider
+    requested_resources = {
+        rc_cache.RC_CACHE.string_from_id(rc_id): amount
+        for rc_id, amount in rg_ctx.resources.items()}
+
+    # Get a dict, keyed by internal ID of the sharing providers among the
+    # providers, of lists of their anchors, looking them up in one go
+    anchors_by_rp = collections.defaultdict(list)
+    sharing_ids = [rp_id for rp_id, root_id in rp_tuples
+                   if rp_id in rg_ctx.sharing_providers]
+    if sharing_ids:
+        for anchor in res_ctx.anchors_for_sharing_providers(
+                rg_ctx.context, sharing_ids):
+            anchors_by_rp[anchor.rp_id].append(anchor)
 
     # Next, build up a list of allocation requests. These allocation requests
     # are AllocationRequest objects, containing resource provider UUIDs,
@@ -391,7 +494,7 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
     for rp_id, root_id in rp_tuples:
         rp_summary = summaries[rp_id]
         req_obj = _allocation_request_for_provider(
-            rg_ctx.resources, rp_summary.resource_provider,
+            requested_resources, rp_summary.resource_provider,
             suffix=rg_ctx.suffix)
         # Exclude this if its anchor (which is its root) isn't in our
         # prefiltered list of anchors
@@ -399,29 +502,30 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
             alloc_requests.append(req_obj)
         # If this is a sharing provider, we have to include an extra
         # AllocationRequest for every possible anchor.
-        traits = rp_summary.traits
-        if os_traits.MISC_SHARES_VIA_AGGREGATE in traits:
-            anchors = res_ctx.anchors_for_sharing_providers(
-                rg_ctx.context, [rp_summary.resource_provider.id])
-            for anchor in anchors:
+        if rp_id in anchors_by_rp:
+            for anchor in anchors_by_rp[rp_id]:
                 # We already added self
                 if anchor.anchor_id == root_id:
                     continue
                 # Only include if anchor is viable
                 if not rw_ctx.in_filtered_anchors(anchor.anchor_id):
                     continue
-                req_obj = copy.copy(req_obj)
-                req_obj.anchor_root_provider_uuid = anchor.anchor_uuid
-                alloc_requests.append(req_obj)
-    return alloc_requests, list(summaries.values())
+                # The resource requests and mappings are never changed
+                # afterwards, so they can be shared with req_obj.
+                alloc_requests.append(AllocationRequest(
+                    resource_requests=req_obj.resource_requests,
+                    anchor_root_provider_uuid=anchor.anchor_uuid,
+                    mappings=req_obj.mappings))
+    return alloc_requests
 
 
 def _allocation_request_for_provider(requested_resources, provider, suffix):
     """Returns an AllocationRequest object containing AllocationRequestResource
     objects for each resource class in the supplied requested resources dict.
 
-    :param requested_resources: dict, keyed by resource class ID, of amounts
-                                being requested for that resource class
+    :param requested_resources: dict, keyed by resource class name, of
+                                amounts being requested for that resource
+                                class
     :param provider: ResourceProvider object representing the provider of the
                      resources.
     :param suffix: The suffix of the RequestGroup these resources are
@@ -430,9 +534,9 @@ def _allocation_request_for_provider(requested_resources, provider, suffix):
     resource_requests = [
         AllocationRequestResource(
             resource_provider=provider,
-            resource_class=rc_cache.RC_CACHE.string_from_id(rc_id),
+            resource_class=rc_name,
             amount=amount
-        ) for rc_id, amount in requested_resources.items()
+        ) for rc_name, amount in requested_resources.items()
     ]
     # NOTE(efried): This method only produces an AllocationRequest with its
     # anchor in its own tree.  If the provider is a sharing provider, the
@@ -447,45 +551,74 @@ def _allocation_request_for_provider(requested_resources, provider, suffix):
         mappings=mappings)
 
 
+def _get_provider_summaries(context, root_ids):
+    """Returns a dict, keyed by resource provider ID, of ProviderSummary
+    objects for all resource providers in all trees indicated in the
+    ``root_ids``.
+
+    Must be called from within an placement_context_manager.reader
+    (or writer) context.
+    """
+    # Get a dict, keyed by resource provider internal ID, of trait string names
+    # that provider has associated with it
+    prov_traits = trait_obj.get_traits_by_provider_tree(context, root_ids)
+
+    # Grab usage summaries for each provider in the trees. The rows are
+    # consumed by _build_provider_summaries() as they are fetched.
+    usages = _get_usages_by_provider_tree(context, root_ids)
+
+    return _build_provider_summaries(context, usages, prov_traits)
+
+
 def _build_provider_summaries(context, usages, prov_traits):
-    """Given a list of dicts of usage information and a map of providers to
-    their associated string traits, returns a dict, keyed by resource provider
-    ID, of ProviderSummary objects.
+    """Given an iterable of dicts of usage information and a map of providers
+    to their associated string traits, returns a dict, keyed by resource
+    provider ID, of ProviderSummary objects.
 
     :param context: placement.context.RequestContext object
-    :param usages: A list of dicts with the following format:
+    :param usages: An iterable, iterated only once, of dicts with the
+                   following format:
 
         {
             'resource_provider_id': <internal resource provider ID>,
             'resource_provider_uuid': <UUID>,
+            'root_provider_uuid': <UUID>,
+            'parent_provider_uuid': <UUID or None>,
             'resource_class_id': <internal resource class ID>,
+            'resource_class_name': <resource class name>,
             'total': integer,
             'reserved': integer,
             'allocation_ratio': float,
+            'max_unit': integer,
+            'used': integer,
         }
     :param prov_traits: A dict, keyed by internal resource provider ID, of
                         string trait names associated with that provider
     """
-    # Before we go creating provider summary objects, first grab all the
-    # provider information (including root, parent and UUID information) for
-    # all providers involved in our operation
-    rp_ids = set(usage['resource_provider_id'] for usage in usages)
-    provider_ids = res_ctx.provider_ids_from_rp_ids(context, rp_ids)
-
     # Build up a dict, keyed by internal resource provider ID, of
     # ProviderSummary objects containing one or more ProviderSummaryResource
     # objects representing the resources the provider has inventory for.
     summaries = {}
+    # The uuid of a provider is also the root or parent uuid of others, but
+    # each row brings its own copy of it. Keep a single string object per
+    # uuid, so that the many comparisons and dict lookups of these uuids
+    # while building and merging the candidates are identity checks. This
+    # is like intern(), which doesn't take unicode strings on python 2.
+    uuids = {}
     for usage in usages:
         rp_id = usage['resource_provider_id']
         summary = summaries.get(rp_id)
         if not summary:
-            pids = provider_ids[rp_id]
+            rp_uuid = usage['resource_provider_uuid']
+            root_uuid = usage['root_provider_uuid']
+            parent_uuid = usage['parent_provider_uuid']
             summary = ProviderSummary(
                 resource_provider=rp_obj.ResourceProvider(
-                    context, id=pids.id, uuid=pids.uuid,
-                    root_provider_uuid=pids.root_uuid,
-                    parent_provider_uuid=pids.parent_uuid),
+                    context, id=rp_id,
+                    uuid=uuids.setdefault(rp_uuid, rp_uuid),
+                    root_provider_uuid=uuids.setdefault(root_uuid, root_uuid),
+                    parent_provider_uuid=uuids.setdefault(
+                        parent_uuid, parent_uuid)),
                 resources=[],
             )
             summaries[rp_id] = summary
@@ -500,17 +633,14 @@ def _build_provider_summaries(context, usages, prov_traits):
             # Let's skip the following and leave "ProviderSummary.resources"
             # field empty.
             continue
-        # NOTE(jaypipes): usage['used'] may be None due to the LEFT JOIN of
-        # the usages subquery, so we coerce NULL values to 0 here. It may
-        # also be a Decimal, as that's the type that mysql tends to return
-        # when func.sum is used in a query. We need an int, otherwise later
-        # JSON serialization will not work.
-        used = int(usage['used'] or 0)
+        # NOTE(jaypipes): usage['used'] may be a Decimal, as that's the type
+        # that mysql tends to return when func.sum is used in a query. We need
+        # an int, otherwise later JSON serialization will not work.
+        used = int(usage['used'])
         allocation_ratio = usage['allocation_ratio']
         cap = int((usage['total'] - usage['reserved']) * allocation_ratio)
-        rc_name = rc_cache.RC_CACHE.string_from_id(rc_id)
         rpsr = ProviderSummaryResource(
-            resource_class=rc_name,
+            resource_class=usage['resource_class_name'],
             capacity=cap,
             used=used,
             max_unit=usage['max_unit'],
@@ -519,57 +649,81 @@ def _build_provider_summaries(context, usages, prov_traits):
     return summaries
 
 
-def _check_traits_for_alloc_request(res_requests, summaries, required_traits,
-                                    forbidden_traits):
-    """Given a list of AllocationRequestResource objects, check if that
-    combination can provide trait constraints. If it can, returns all
-    resource provider internal IDs in play, else return an empty list.
-
-    TODO(tetsuro): For optimization, we should move this logic to SQL in
-                   res_ctx.get_trees_matching_all().
-
-    :param res_requests: a list of AllocationRequestResource objects that have
-                         resource providers to be checked if they collectively
-                         satisfy trait constraints in the required_traits and
-                         forbidden_traits parameters.
-    :param summaries: dict, keyed by resource provider id, of ProviderSummary
-                      objects containing usage and trait information for
-                      resource providers involved in the overall request
-    :param required_traits: A map, keyed by trait string name, of required
-                            trait internal IDs that each *allocation request's
-                            set of providers* must *collectively* have
-                            associated with them
-    :param forbidden_traits: A map, keyed by trait string name, of trait
-                             internal IDs that a resource provider must
-                             not have.
+def _product_with_traits(request_groups, bits_by_rp, trait_bits):
+    """Given a list of lists of AllocationRequestResource objects, returns an
+    iterator over the tuples picking one AllocationRequestResource from each
+    list, like itertools.product() does, but only over those whose resource
+    providers collectively have all the required traits.
+
+    Rather than checking every tuple of the product, the tuples are built up
+    one list at a time, and a partial tuple is abandoned as soon as the
+    providers in it and in the remaining lists can no longer have all the
+    required traits. The shortest lists are picked from first, so that fewer
+    partial tuples are built before one is abandoned. The tuples are still
+    ordered like request_groups.
+
+    NOTE: Providers having forbidden traits are already filtered out in
+          res_ctx.get_trees_matching_all(), so only the required traits,
+          which may be provided collectively by providers across a tree and
+          sharing providers, are checked here.
+
+    :param request_groups: a list of lists of AllocationRequestResource
+                           objects, one list per requested resource class.
+    :param bits_by_rp: dict, keyed by resource provider id, of the bitwise OR
+                       of the bits in trait_bits of the required traits each
+                       provider in request_groups has
+    :param trait_bits: dict, keyed by string name of required traits that
+                       each *allocation request's set of providers* must
+                       *collectively* have associated with them, of a
+                       distinct bit for each trait
     """
-    all_prov_ids = []
-    all_traits = set()
-    for res_req in res_requests:
-        rp_id = res_req.resource_provider.id
-        rp_summary = summaries[rp_id]
-        rp_traits = set(rp_summary.traits)
-
-        # Check if there are forbidden_traits
-        conflict_traits = set(forbidden_traits) & set(rp_traits)
-        if conflict_traits:
-            LOG.debug('Excluding resource provider %s, it has '
-                      'forbidden traits: (%s).',
-                      rp_id, ', '.join(conflict_traits))
-            return []
-
-        all_prov_ids.append(rp_id)
-        all_traits |= rp_traits
-
-    # Check if there are missing traits
-    missing_traits = set(required_traits) - all_traits
-    if missing_traits:
-        LOG.debug('Excluding a set of allocation candidate %s : '
-                  'missing traits %s are not satisfied.',
-                  all_prov_ids, ','.join(missing_traits))
-        return []
+    if not trait_bits:
+        return itertools.product(*request_groups)
+
+    required = 0
+    for bit in trait_bits.values():
+        required |= bit
+    # The indexes of request_groups in the order we pick from them
+    order = sorted(range(len(request_groups)),
+                   key=lambda i: len(request_groups[i]))
+    bits_by_group = [
+        [bits_by_rp[arr.resource_provider.id] for arr in request_groups[i]]
+        for i in order]
+    # bits_left[i] has the bits of the traits of the providers in the lists
+    # we pick from at and after the i-th place, i.e. all the traits a partial
+    # tuple of length i can still get.
+    bits_left = [0]
+    for group_bits in reversed(bits_by_group):
+        bits = bits_left[0]
+        for rp_bits in group_bits:
+            bits |= rp_bits
+        bits_left.insert(0, bits)
+
+    if bits_left[0] != required:
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Excluding allocation candidates from resource '
+                      'providers %s : missing traits %s are not satisfied.',
+                      sorted(set(arr.resource_provider.id
+                                 for arrs in request_groups for arr in arrs)),
+                      ','.join(name for name, bit in trait_bits.items()
+                               if not bits_left[0] & bit))
+        return iter([])
+
+    def _extend(idx, res_requests, bits):
+        if idx == len(order):
+            yield tuple(res_requests)
+            return
+        group_idx = order[idx]
+        for arr, arr_bits in zip(request_groups[group_idx],
+                                 bits_by_group[idx]):
+            new_bits = bits | arr_bits
+            if new_bits | bits_left[idx + 1] != required:
+                continue
+            res_requests[group_idx] = arr
+            for combination in _extend(idx + 1, res_requests, new_bits):
+                yield combination
 
-    return all_prov_ids
+    return _extend(0, [None] * len(request_groups), 0)
 
 
 def _consolidate_allocation_requests(areqs):
@@ -578,13 +732,18 @@ def _consolidate_allocation_requests(areqs):
     :param areqs: A list containing one AllocationRequest for each input
             RequestGroup.  This may mean that multiple resource_requests
             contain resource amounts of the same class from the same provider.
-    :return: A single consolidated AllocationRequest, containing no
+    :return: A tuple of (key, AllocationRequest), where the
+            AllocationRequest is a single consolidated one containing no
             resource_requests with duplicated (resource_provider,
-            resource_class).
+            resource_class), and the key is a hashable value identifying it,
+            equal for equal consolidated AllocationRequests.
     """
-    # Construct a dict, keyed by resource provider UUID + resource class, of
-    # AllocationRequestResource, consolidating as we go.
-    arrs_by_rp_rc = {}
+    # Construct dicts, keyed by resource provider UUID + resource class, of
+    # the amounts, summed up as we go, and of the resource providers and
+    # classes, from which the consolidated AllocationRequestResources are
+    # built at the end.
+    amounts_by_rp_rc = {}
+    rp_rcs_by_rp_rc = {}
     # areqs must have at least one element.  Save the anchor to populate the
     # returned AllocationRequest.
     anchor_rp_uuid = areqs[0].anchor_root_provider_uuid
@@ -599,43 +758,70 @@ def _consolidate_allocation_requests(areqs):
                 "anchor!")
         for arr in areq.resource_requests:
             key = _rp_rc_key(arr.resource_provider, arr.resource_class)
-            if key not in arrs_by_rp_rc:
-                arrs_by_rp_rc[key] = copy.copy(arr)
+            if key not in amounts_by_rp_rc:
+                amounts_by_rp_rc[key] = arr.amount
+                rp_rcs_by_rp_rc[key] = (
+                    arr.resource_provider, arr.resource_class)
             else:
-                arrs_by_rp_rc[key].amount += arr.amount
+                amounts_by_rp_rc[key] += arr.amount
         for suffix, providers in areq.mappings.items():
             mappings[suffix].update(providers)
-    return AllocationRequest(
-        resource_requests=list(arrs_by_rp_rc.values()),
+    resource_requests = []
+    for key, amount in amounts_by_rp_rc.items():
+        rp, rc = rp_rcs_by_rp_rc[key]
+        resource_requests.append(AllocationRequestResource(
+            resource_provider=rp, resource_class=rc, amount=amount))
+    # Like AllocationRequest.__eq__, the key ignores the order of the
+    # resource requests, but it is made of plain tuples, which are cheaper to
+    # hash and compare than the AllocationRequestResource objects.
+    canonical_key = (
+        frozenset(amounts_by_rp_rc.items()),
+        frozenset((suffix, frozenset(providers))
+                  for suffix, providers in mappings.items()))
+    return canonical_key, AllocationRequest(
+        resource_requests=resource_requests,
         anchor_root_provider_uuid=anchor_rp_uuid,
         mappings=mappings)
 
 
-@db_api.placement_context_manager.reader
 def _get_usages_by_provider_tree(ctx, root_ids):
     """Returns a row iterator of usage records grouped by provider ID
     for all resource providers in all trees indicated in the ``root_ids``.
+
+    Must be called from within an placement_context_manager.reader
+    (or writer) context. The rows are fetched as they are iterated, so the
+    iterator must be consumed within that context, and before another query
+    is run.
     """
     # We build up a SQL expression that looks like this:
     # SELECT
     #   rp.id as resource_provider_id
     # , rp.uuid as resource_provider_uuid
+    # , root.uuid as root_provider_uuid
+    # , parent.uuid as parent_provider_uuid
     # , inv.resource_class_id
+    # , rc.name AS resource_class_name
     # , inv.total
     # , inv.reserved
     # , inv.allocation_ratio
     # , inv.max_unit
-    # , usage.used
+    # , COALESCE(usage.used, 0) AS used
     # FROM resource_providers AS rp
+    # INNER JOIN resource_providers AS root
+    #  ON rp.root_provider_id = root.id
+    # LEFT JOIN resource_providers AS parent
+    #  ON rp.parent_provider_id = parent.id
     # LEFT JOIN inventories AS inv
     #  ON rp.id = inv.resource_provider_id
+    # LEFT JOIN resource_classes AS rc
+    #  ON inv.resource_class_id = rc.id
     # LEFT JOIN (
     #   SELECT resource_provider_id, resource_class_id, SUM(used) as used
     #   FROM allocations
-    #   JOIN resource_providers
-    #     ON allocations.resource_provider_id = resource_providers.id
-    #     AND (resource_providers.root_provider_id IN($root_ids)
-    #          OR resource_providers.id IN($root_ids))
+    #   WHERE resource_provider_id IN (
+    #     SELECT id FROM resource_providers
+    #     WHERE root_provider_id IN ($root_ids)
+    #   )
     #   GROUP BY resource_provider_id, resource_class_id
     # )
     # AS usage
@@ -645,28 +831,41 @@ def _get_usages_by_provider_tree(ctx, root_ids):
     rpt = sa.alias(_RP_TBL, name="rp")
     inv = sa.alias(_INV_TBL, name="inv")
     # Build our derived table (subquery in the FROM clause) that sums used
-    # amounts for resource provider and resource class
-    derived_alloc_to_rp = sa.join(
-        _ALLOC_TBL, _RP_TBL,
-        sa.and_(_ALLOC_TBL.c.resource_provider_id == _RP_TBL.c.id,
-                _RP_TBL.c.root_provider_id.in_(root_ids))
-    )
+    # amounts for resource provider and resource class. The allocations only
+    # need filtering by the providers in the trees, which doesn't require
+    # joining them to resource_providers.
+    rps_in_trees = sa.select([_RP_TBL.c.id]).where(
+        _RP_TBL.c.root_provider_id.in_(root_ids))
     usage = sa.alias(
         sa.select([
             _ALLOC_TBL.c.resource_provider_id,
             _ALLOC_TBL.c.resource_class_id,
             sql.func.sum(_ALLOC_TBL.c.used).label('used'),
-        ]).select_from(derived_alloc_to_rp).group_by(
+        ]).where(
+            _ALLOC_TBL.c.resource_provider_id.in_(rps_in_trees)
+        ).group_by(
             _ALLOC_TBL.c.resource_provider_id,
             _ALLOC_TBL.c.resource_class_id
         ),
         name='usage')
+    # Get the root and parent provider UUIDs along with the providers
+    root = sa.alias(_RP_TBL, name="root")
+    parent = sa.alias(_RP_TBL, name="parent")
+    rpt_root_join = sa.join(rpt, root, rpt.c.root_provider_id == root.c.id)
+    rpt_parent_join = sa.outerjoin(
+        rpt_root_join, parent, rpt.c.parent_provider_id == parent.c.id)
     # Build a join between the resource providers and inventories table
-    rpt_inv_join = sa.outerjoin(rpt, inv,
+    rpt_inv_join = sa.outerjoin(rpt_parent_join, inv,
                                 rpt.c.id == inv.c.resource_provider_id)
+    # The resource class names are joined in rather than looked up in the
+    # resource class cache, which could query the database on a miss while
+    # the rows are still being fetched.
+    rc = sa.alias(_RC_TBL, name="rc")
+    inv_rc_join = sa.outerjoin(rpt_inv_join, rc,
+                               inv.c.resource_class_id == rc.c.id)
     # And then join to the derived table of usages
     usage_join = sa.outerjoin(
-        rpt_inv_join,
+        inv_rc_join,
         usage,
         sa.and_(
             usage.c.resource_provider_id == inv.c.resource_provider_id,
@@ -676,70 +875,137 @@ def _get_usages_by_provider_tree(ctx, root_ids):
     query = sa.select([
         rpt.c.id.label("resource_provider_id"),
         rpt.c.uuid.label("resource_provider_uuid"),
+        root.c.uuid.label("root_provider_uuid"),
+        parent.c.uuid.label("parent_provider_uuid"),
         inv.c.resource_class_id,
+        rc.c.name.label("resource_class_name"),
+        # NOTE: The capacity is computed in python, like
+        # Inventory.capacity. allocation_ratio is a single precision FLOAT
+        # on MySQL, so computing it in SQL can round it down differently.
         inv.c.total,
         inv.c.reserved,
         inv.c.allocation_ratio,
         inv.c.max_unit,
-        usage.c.used,
+        # usage.used is NULL due to the LEFT JOIN of the usages subquery for
+        # the inventories without allocations.
+        sql.func.coalesce(usage.c.used, 0).label('used'),
     ]).select_from(usage_join).where(
         rpt.c.root_provider_id.in_(root_ids)
     )
-    return ctx.session.execute(query).fetchall()
+    return ctx.session.execute(query)
 
 
-def _exceeds_capacity(areq, psum_res_by_rp_rc):
-    """Checks a (consolidated) AllocationRequest against the provider summaries
-    to ensure that it does not exceed capacity.
+def _exceeds_capacity(areq, keyed_arrs, psum_res_by_rp_rc, amount_by_rp_rc):
+    """Checks an AllocationRequest to be merged with others against the
+    provider summaries to ensure that it does not exceed capacity.
 
     Exceeding capacity can mean the total amount (already used plus this
-    allocation) exceeds the total inventory amount; or this allocation exceeds
-    the max_unit in the inventory record.
-
-    :param areq: An AllocationRequest produced by the
-            `_consolidate_allocation_requests` method.
+    allocation plus the amounts of the same resources in the other
+    AllocationRequests it is merged with) exceeds the total inventory amount;
+    or this allocation plus those amounts exceeds the max_unit in the
+    inventory record.
+
+    :param areq: An AllocationRequest for one RequestGroup.
+    :param keyed_arrs: A list of tuples of (key, AllocationRequestResource),
+            one for each of the resource_requests of areq, where key is the
+            provider + resource class via _rp_rc_key.
     :param psum_res_by_rp_rc: A dict, keyed by provider + resource class via
             _rp_rc_key, of ProviderSummaryResource.
+    :param amount_by_rp_rc: A dict, keyed by provider + resource class via
+            _rp_rc_key, of the amounts requested by the AllocationRequests
+            areq is merged with.
     :return: True if areq exceeds capacity; False otherwise.
     """
-    for arr in areq.resource_requests:
-        key = _rp_rc_key(arr.resource_provider, arr.resource_class)
+    for key, arr in keyed_arrs:
         psum_res = psum_res_by_rp_rc[key]
-        if psum_res.used + arr.amount > psum_res.capacity:
+        amount = amount_by_rp_rc.get(key, 0) + arr.amount
+        if psum_res.used + amount > psum_res.capacity:
             LOG.debug('Excluding the following AllocationRequest because used '
                       '(%d) + amount (%d) > capacity (%d) for resource class '
                       '%s: %s',
-                      psum_res.used, arr.amount, psum_res.capacity,
-                      arr.resource_class, str(areq))
+                      psum_res.used, amount, psum_res.capacity,
+                      arr.resource_class, areq)
             return True
-        if arr.amount > psum_res.max_unit:
+        if amount > psum_res.max_unit:
             LOG.debug('Excluding the following AllocationRequest because '
                       'amount (%d) > max_unit (%d) for resource class %s: %s',
-                      arr.amount, psum_res.max_unit, arr.resource_class,
-                      str(areq))
+                      amount, psum_res.max_unit, arr.resource_class, areq)
             return True
     return False
 
 
 # TODO(efried): Move _merge_candidates to rw_ctx?
-def _merge_candidates(candidates, rw_ctx):
-    """Given a dict, keyed by RequestGroup suffix, of tuples of
-    (allocation_requests, provider_summaries), produce a single tuple of
+def _merge_candidates(candidates, all_psums, rw_ctx):
+    """Given a dict, keyed by RequestGroup suffix, of lists of
+    allocation_requests, and the provider_summaries of all the providers
+    involved in them, produce a single tuple of
     (allocation_requests, provider_summaries) that appropriately incorporates
     the elements from each.
 
-    Each (alloc_reqs, prov_sums) in `candidates` satisfies one RequestGroup.
+    Each list of alloc_reqs in `candidates` satisfies one RequestGroup.
     This method creates a list of alloc_reqs, *each* of which satisfies *all*
     of the RequestGroups.
 
     For that merged list of alloc_reqs, a corresponding provider_summaries is
     produced.
 
-    :param candidates: A dict, keyed by suffix string or '', of tuples of
-            (allocation_requests, provider_summaries) to be merged.
+    :param candidates: A dict, keyed by suffix string or '', of lists of
+            allocation_requests to be merged.
+    :param all_psums: A list of provider_summaries for all providers in the
+            trees involved in the allocation_requests in `candidates`.
     :param rw_ctx: RequestWideSearchContext.
     :return: A tuple of (allocation_requests, provider_summaries).
     """
+    if len(candidates) == 1 and not rw_ctx.same_subtrees:
+        # With a single RequestGroup, there is nothing to merge: the
+        # group_policy is trivially satisfied, and each AllocationRequest
+        # has at most one resource request per provider + resource class,
+        # whose capacity was already checked when getting the candidates.
+        # Only the same requests found from several anchors, via sharing
+        # providers, need to be dropped.
+        areqs = {}
+        tree_uuids = set()
+        for areq in next(iter(candidates.values())):
+            key = frozenset(
+                (_rp_rc_key(arr.resource_provider, arr.resource_class),
+                 arr.amount)
+                for arr in areq.resource_requests)
+            if key in areqs:
+                continue
+            areqs[key] = areq
+            for arr in areq.resource_requests:
+                tree_uuids.add(arr.resource_provider.root_provider_uuid)
+    else:
+        areqs, tree_uuids = _merge_areq_lists(candidates, all_psums, rw_ctx)
+
+    # It's possible we've filtered out everything.  If so, short out.
+    if not areqs:
+        return [], []
+
+    # Now we have to produce provider summaries.  The provider summaries in
+    # the all_psums input contain all the information; we just need to
+    # filter it down to only the providers in trees represented by our merged
+    # list of allocation requests.
+    psums = [psum for psum in all_psums if
+             psum.resource_provider.root_provider_uuid in tree_uuids]
+
+    LOG.debug('Merging candidates yields %d allocation requests and %d '
+              'provider summaries', len(areqs), len(psums))
+    return list(areqs.values()), psums
+
+
+def _merge_areq_lists(candidates, all_psums, rw_ctx):
+    """Merges the lists of allocation_requests of several RequestGroups.
+
+    :param candidates: A dict, keyed by suffix string or '', of lists of
+            allocation_requests to be merged.
+    :param all_psums: A list of provider_summaries for all providers in the
+            trees involved in the allocation_requests in `candidates`.
+    :param rw_ctx: RequestWideSearchContext.
+    :return: A tuple of (areqs, tree_uuids), where areqs is a dict, keyed by
+            a canonical key, of the merged AllocationRequests, and tree_uuids
+            is a set of the root provider uuids of the providers in them.
+    """
     # Build a dict, keyed by anchor root provider UUID, of dicts, keyed by
     # suffix, of nonempty lists of AllocationRequest.  Each inner dict must
     # possess all of the suffix keys to be viable (i.e. contains at least
@@ -754,40 +1020,45 @@ def _merge_candidates(candidates, rw_ctx):
     #     },
     #     ...
     #   }
-    areq_lists_by_anchor = collections.defaultdict(
-        lambda: collections.defaultdict(list))
-    # Save off all the provider summaries lists - we'll use 'em later.
-    all_psums = []
+    areq_lists_by_anchor = collections.defaultdict(_list_dd)
     # Construct a dict, keyed by resource provider + resource class, of
     # ProviderSummaryResource.  This will be used to do a final capacity
     # check/filter on each merged AllocationRequest.
     psum_res_by_rp_rc = {}
     # A dict of parent uuids keyed by rp uuids
     parent_uuid_by_rp_uuid = {}
-    for suffix, (areqs, psums) in candidates.items():
+    for suffix, areqs in candidates.items():
         for areq in areqs:
             anchor = areq.anchor_root_provider_uuid
             areq_lists_by_anchor[anchor][suffix].append(areq)
-        for psum in psums:
-            all_psums.append(psum)
-            parent_uuid_by_rp_uuid[psum.resource_provider.uuid] = (
-                psum.resource_provider.parent_provider_uuid)
-            for psum_res in psum.resources:
-                key = _rp_rc_key(
-                    psum.resource_provider, psum_res.resource_class)
-                psum_res_by_rp_rc[key] = psum_res
+    for psum in all_psums:
+        parent_uuid_by_rp_uuid[psum.resource_provider.uuid] = (
+            psum.resource_provider.parent_provider_uuid)
+        for psum_res in psum.resources:
+            key = _rp_rc_key(psum.resource_provider, psum_res.resource_class)
+            psum_res_by_rp_rc[key] = psum_res
+    # A dict of the ancestors of each provider, including itself, keyed by
+    # rp uuids. The same providers are checked against same_subtree again
+    # and again, so the trees are only walked once, here.
+    ancestors_by_rp_uuid = {}
+    if rw_ctx.same_subtrees:
+        ancestors_by_rp_uuid = _get_ancestors_by_rp_uuid(
+            parent_uuid_by_rp_uuid)
 
     # Create all combinations picking one AllocationRequest from each list
-    # for each anchor.
-    areqs = set()
+    # for each anchor. A dict, keyed by the canonical key of the merged
+    # AllocationRequests, to get rid of the duplicates.
+    areqs = {}
+    # The root provider uuids of the trees of the providers in the merged
+    # AllocationRequests
+    tree_uuids = set()
     all_suffixes = set(candidates)
-    num_granular_groups = len(all_suffixes - set(['']))
     for areq_lists_by_suffix in areq_lists_by_anchor.values():
         # Filter out any entries that don't have allocation requests for
         # *all* suffixes (i.e. all RequestGroups)
         if set(areq_lists_by_suffix) != all_suffixes:
             continue
-        # We're using itertools.product to go from this:
+        # We're using _product_with_policies to go from this:
         # areq_lists_by_suffix = {
         #     '':   [areq__A,   areq__B,   ...],
         #     '1':  [areq_1_A,  areq_1_B,  ...],
@@ -801,22 +1072,15 @@ def _merge_candidates(candidates, rw_ctx):
         #   [areq__A, areq_1_B, ..., areq_42_B],  AllocationRequest from each
         #   [areq__B, areq_1_A, ..., areq_42_A],  RequestGroup. So taken as a
         #   [areq__B, areq_1_A, ..., areq_42_B],  whole, each list is a viable
-        #   [areq__B, areq_1_B, ..., areq_42_A],  (preliminary) candidate to
-        #   [areq__B, areq_1_B, ..., areq_42_B],  return.
+        #   [areq__B, areq_1_B, ..., areq_42_A],  candidate to return.
+        #   [areq__B, areq_1_B, ..., areq_42_B],
         #   ...,
         # ]
-        for areq_list in itertools.product(
-                *list(areq_lists_by_suffix.values())):
-            # At this point, each AllocationRequest in areq_list is still
-            # marked as use_same_provider. This is necessary to filter by group
-            # policy, which enforces how these interact with each other.
-            # TODO(efried): Move _satisfies_group_policy to rw_ctx?
-            if not _satisfies_group_policy(
-                    areq_list, rw_ctx.group_policy, num_granular_groups):
-                continue
-            if not _satisfies_same_subtree(
-                    areq_list, rw_ctx.same_subtrees, parent_uuid_by_rp_uuid):
-                continue
+        # leaving out those that don't satisfy the group policy and the
+        # same_subtree policy or exceed capacity.
+        for areq_list in _product_with_policies(
+                areq_lists_by_suffix, rw_ctx, ancestors_by_rp_uuid,
+                psum_res_by_rp_rc):
             # Now we go from this (where 'arr' is AllocationRequestResource):
             # [ areq__B(arrX, arrY, arrZ),
             #   areq_1_A(arrM, arrN),
@@ -828,39 +1092,16 @@ def _merge_candidates(candidates, rw_ctx):
             # Note that the information telling us which RequestGroup led to
             # which piece of the AllocationRequest has been lost from the outer
             # layer of the data structure (the key of areq_lists_by_suffix).
-            # => We needed that to be present for the previous filter; we need
-            # it to be *absent* for the next one.
             # => However, it still exists embedded in each
             # AllocationRequestResource. That's needed to construct the
             # mappings for the output.
-            areq = _consolidate_allocation_requests(areq_list)
-            # Since we sourced this AllocationRequest from multiple
-            # *independent* queries, it's possible that the combined result
-            # now exceeds capacity where amounts of the same RP+RC were
-            # folded together.  So do a final capacity check/filter.
-            # TODO(efried): Move _exceeds_capacity to rw_ctx?
-            if _exceeds_capacity(areq, psum_res_by_rp_rc):
+            key, areq = _consolidate_allocation_requests(areq_list)
+            if key in areqs:
                 continue
-            areqs.add(areq)
-
-    # It's possible we've filtered out everything.  If so, short out.
-    if not areqs:
-        return [], []
-
-    # Now we have to produce provider summaries.  The provider summaries in
-    # the candidates input contain all the information; we just need to
-    # filter it down to only the providers in trees represented by our merged
-    # list of allocation requests.
-    tree_uuids = set()
-    for areq in areqs:
-        for arr in areq.resource_requests:
-            tree_uuids.add(arr.resource_provider.root_provider_uuid)
-    psums = [psum for psum in all_psums if
-             psum.resource_provider.root_provider_uuid in tree_uuids]
-
-    LOG.debug('Merging candidates yields %d allocation requests and %d '
-              'provider summaries', len(areqs), len(psums))
-    return list(areqs), psums
+            areqs[key] = areq
+            for arr in areq.resource_requests:
+                tree_uuids.add(arr.resource_provider.root_provider_uuid)
+    return areqs, tree_uuids
 
 
 def _rp_rc_key(rp, rc):
@@ -868,53 +1109,125 @@ def _rp_rc_key(rp, rc):
     return rp.uuid, rc
 
 
-def _satisfies_group_policy(areqs, group_policy, num_granular_groups):
-    """Applies group_policy to a list of AllocationRequest.
-
-    Returns True or False, indicating whether this list of
-    AllocationRequest satisfies group_policy, as follows:
-
-    * "isolate": Each AllocationRequest with use_same_provider=True
-                 is satisfied by a single resource provider.  If the "isolate"
-                 policy is in effect, each such AllocationRequest must be
-                 satisfied by a *unique* resource provider.
-    * "none" or None: Always returns True.
-
-    :param areqs: A list containing one AllocationRequest for each input
-            RequestGroup.
-    :param group_policy: String indicating how RequestGroups should interact
-            with each other.  If the value is "isolate", we will return False
-            if AllocationRequests that came from RequestGroups keyed by
-            nonempty suffixes are satisfied by the same provider.
-    :param num_granular_groups: The number of granular (use_same_provider=True)
-            RequestGroups in the request.
-    :return: True if areqs satisfies group_policy; False otherwise.
+def _product_with_policies(areq_lists_by_suffix, rw_ctx,
+                           ancestors_by_rp_uuid, psum_res_by_rp_rc):
+    """Generates the combinations, as tuples, of one AllocationRequest from
+    each list in areq_lists_by_suffix which satisfy group_policy and the
+    same_subtree policy, and don't exceed capacity once merged. The
+    AllocationRequests are in the same order in every tuple, but not
+    necessarily in the order of the suffixes in areq_lists_by_suffix.
+
+    The combinations are built one suffix at a time, and each policy is
+    checked as soon as enough of the combination is picked to check it. So a
+    partial combination failing a policy is not extended any further, rather
+    than all the combinations it is part of being built and rejected.
+
+    * group_policy "isolate": Each AllocationRequest with
+                 use_same_provider=True is satisfied by a single resource
+                 provider, which must be *unique*. This is checked as each
+                 such AllocationRequest is picked.
+    * same_subtree: Checked when the AllocationRequests of all the suffixes
+                 in the same_subtree are picked.
+    * capacity: Since we sourced the AllocationRequests from multiple
+                 *independent* queries, it's possible that the combined result
+                 exceeds capacity where amounts of the same RP+RC are folded
+                 together. The amounts only add up, so this is checked as each
+                 AllocationRequest is picked.
+
+    :param areq_lists_by_suffix: A dict, keyed by suffix, of lists of
+            AllocationRequest.
+    :param rw_ctx: RequestWideSearchContext.
+    :param ancestors_by_rp_uuid: A dict, keyed by rp uuids, of frozensets of
+            the uuids of the provider and all its ancestors.
+    :param psum_res_by_rp_rc: A dict, keyed by provider + resource class via
+            _rp_rc_key, of ProviderSummaryResource.
     """
-    if group_policy != 'isolate':
-        # group_policy="none" means no filtering
-        return True
+    # Pick from the shortest lists first, so that the fewest partial
+    # combinations are built before each policy can be checked, and those
+    # failing it cut off as many combinations as possible.
+    suffixes = sorted(areq_lists_by_suffix,
+                      key=lambda suffix: len(areq_lists_by_suffix[suffix]))
+    # With a single granular group, there is no other group to isolate it
+    # from.
+    num_granular_groups = len([suffix for suffix in suffixes if suffix])
+    isolate = rw_ctx.group_policy == 'isolate' and num_granular_groups > 1
+    # The same_subtree constraints to check once the AllocationRequest at
+    # each index of the combination is picked, i.e. those having the suffix
+    # at that index as their last suffix.
+    index_by_suffix = {suffix: i for i, suffix in enumerate(suffixes)}
+    same_subtrees_by_index = collections.defaultdict(list)
+    for same_subtree in rw_ctx.same_subtrees:
+        index = max(index_by_suffix[suffix] for suffix in same_subtree)
+        same_subtrees_by_index[index].append(same_subtree)
+
+    # The lists of AllocationRequests of each suffix, each along with the
+    # keys of its resource requests via _rp_rc_key. Those are needed for
+    # every combination the AllocationRequest is part of, so get them once.
+    keyed_areq_lists = [
+        [(areq, [(_rp_rc_key(arr.resource_provider, arr.resource_class), arr)
+                 for arr in areq.resource_requests])
+         for areq in areq_lists_by_suffix[suffix]]
+        for suffix in suffixes]
+
+    areq_list = [None] * len(suffixes)
+    # The providers of the AllocationRequests with use_same_provider=True in
+    # the partial combination.
+    granular_rp_uuids = set()
+    # The amounts requested by the partial combination, keyed by provider +
+    # resource class via _rp_rc_key.
+    amount_by_rp_rc = collections.defaultdict(int)
+
+    def _extend(index):
+        if index == len(suffixes):
+            yield tuple(areq_list)
+            return
+        suffix = suffixes[index]
+        for areq, keyed_arrs in keyed_areq_lists[index]:
+            areq_list[index] = areq
+            # At this point, each AllocationRequest in areq_list is still
+            # marked as use_same_provider. This is necessary to filter by
+            # group policy, which enforces how these interact with each other.
+            # All the resource_requests are satisfied by the same provider
+            # by definition because use_same_provider is True.
+            rp_uuids = None
+            if isolate and areq.use_same_provider:
+                rp_uuids = areq.mappings[suffix]
+                if not granular_rp_uuids.isdisjoint(rp_uuids):
+                    # Most partial combinations may be rejected here, so
+                    # don't copy them for nothing.
+                    if LOG.isEnabledFor(logging.DEBUG):
+                        LOG.debug('Excluding the following set of '
+                                  'AllocationRequest, and any set including '
+                                  'it, because group_policy=isolate and more '
+                                  'than one granular group is satisfied by '
+                                  'the same provider: %s',
+                                  areq_list[:index + 1])
+                    continue
+            same_subtrees = same_subtrees_by_index.get(index)
+            if same_subtrees and not _satisfies_same_subtree(
+                    areq_list[:index + 1], same_subtrees,
+                    ancestors_by_rp_uuid):
+                continue
+            if _exceeds_capacity(areq, keyed_arrs, psum_res_by_rp_rc,
+                                 amount_by_rp_rc):
+                continue
 
-    # The number of unique resource providers referenced in the request groups
-    # having use_same_provider=True must be equal to the number of granular
-    # groups.
-    num_granular_groups_in_areqs = len(set().union(*(
-        # We can reliably use the first value of provider uuids in mappings:
-        # all the resource_requests are satisfied by the same provider
-        # by definition because use_same_provider is True.
-        list(areq.mappings.values())[0] for areq in areqs
-        if areq.use_same_provider)))
-    if num_granular_groups == num_granular_groups_in_areqs:
-        return True
-    LOG.debug('Excluding the following set of AllocationRequest because '
-              'group_policy=isolate and the number of granular groups in the '
-              'set (%d) does not match the number of granular groups in the '
-              'request (%d): %s',
-              num_granular_groups_in_areqs, num_granular_groups, str(areqs))
-    return False
+            if rp_uuids:
+                granular_rp_uuids.update(rp_uuids)
+            for key, arr in keyed_arrs:
+                amount_by_rp_rc[key] += arr.amount
+            for combination in _extend(index + 1):
+                yield combination
+            if rp_uuids:
+                granular_rp_uuids.difference_update(rp_uuids)
+            for key, arr in keyed_arrs:
+                amount_by_rp_rc[key] -= arr.amount
+
+    return _extend(0)
 
 
 def _satisfies_same_subtree(
-        areqs, same_subtrees, parent_uuid_by_rp_uuid):
+        areqs, same_subtrees, ancestors_by_rp_uuid):
     """Applies same_subtree policy to a list of AllocationRequest.
 
     :param areqs: A list containing one AllocationRequest for each input
@@ -923,20 +1236,24 @@ def _satisfies_same_subtree(
             If provided, all of the resource providers satisfying the specified
             request groups must be rooted at one of the resource providers
             satisfying the request groups.
-    :param parent_uuid_by_rp_uuid: A dict of parent uuids keyed by rp uuids.
+    :param ancestors_by_rp_uuid: A dict, keyed by rp uuids, of frozensets of
+            the uuids of the provider and all its ancestors.
     :return: True if areqs satisfies same_subtree policy; False otherwise.
     """
     for same_subtree in same_subtrees:
         # Collect RP uuids that must satisfy a single same_subtree constraint.
-        rp_uuids = set().union(*(areq.mappings.get(suffix) for areq in areqs
-                               for suffix in same_subtree
-                               if areq.mappings.get(suffix)))
-        if not _check_same_subtree(rp_uuids, parent_uuid_by_rp_uuid):
+        rp_uuids = set()
+        for areq in areqs:
+            for suffix in same_subtree:
+                providers = areq.mappings.get(suffix)
+                if providers:
+                    rp_uuids.update(providers)
+        if not _check_same_subtree(rp_uuids, ancestors_by_rp_uuid):
             return False
     return True
 
 
-def _check_same_subtree(rp_uuids, parent_uuid_by_rp_uuid):
+def _check_same_subtree(rp_uuids, ancestors_by_rp_uuid):
     """Returns True if given rp uuids are all in the same subtree.
 
     Note: The rps are in the same subtree means all the providers are
@@ -944,24 +1261,35 @@ def _check_same_subtree(rp_uuids, parent_uuid_by_rp_uuid):
     """
     if len(rp_uuids) == 1:
         return True
-    # A set of uuids of common ancestors of each rp in question
-    common_ancestors = set.intersection(*(
-        _get_ancestors_by_one_uuid(rp_uuid, parent_uuid_by_rp_uuid)
-        for rp_uuid in rp_uuids))
-    # if any of the rp_uuid is in the common_ancestors set, then
-    # we know that, that rp_uuid is the root of the other rp_uuids
-    # in this same_subtree constraint.
-    return len(common_ancestors.intersection(rp_uuids)) != 0
-
-
-def _get_ancestors_by_one_uuid(
-        rp_uuid, parent_uuid_by_rp_uuid, ancestors=None):
-    """Returns a set of uuids of ancestors for a given rp uuid"""
-    if ancestors is None:
-        ancestors = set([rp_uuid])
-    parent_uuid = parent_uuid_by_rp_uuid[rp_uuid]
-    if parent_uuid is None:
-        return ancestors
-    ancestors.add(parent_uuid)
-    return _get_ancestors_by_one_uuid(
-        parent_uuid, parent_uuid_by_rp_uuid, ancestors=ancestors)
+    # The root of the other rp_uuids in this same_subtree constraint, if
+    # there is one, is the rp closest to the root of the tree, i.e. the one
+    # with the fewest ancestors. So we only need to check whether that rp is
+    # an ancestor of all the others, and can stop at the first which it isn't.
+    top_uuid = min(rp_uuids,
+                   key=lambda rp_uuid: len(ancestors_by_rp_uuid[rp_uuid]))
+    return all(top_uuid in ancestors_by_rp_uuid[rp_uuid]
+               for rp_uuid in rp_uuids)
+
+
+def _get_ancestors_by_rp_uuid(parent_uuid_by_rp_uuid):
+    """Returns a dict, keyed by rp uuid, of frozensets of the uuids of the
+    provider and all its ancestors.
+
+    :param parent_uuid_by_rp_uuid: A dict of parent uuids keyed by rp uuids.
+    """
+    ancestors_by_rp_uuid = {}
+    for rp_uuid in parent_uuid_by_rp_uuid:
+        # Walk up the tree until a provider we already know the ancestors
+        # of, or past the root.
+        chain = []
+        uuid = rp_uuid
+        while uuid is not None and uuid not in ancestors_by_rp_uuid:
+            chain.append(uuid)
+            uuid = parent_uuid_by_rp_uuid[uuid]
+        # Then walk back down, adding each provider to its parent's
+        # ancestors.
+        ancestors = ancestors_by_rp_uuid.get(uuid, frozenset())
+        for uuid in reversed(chain):
+            ancestors = ancestors | frozenset([uuid])
+            ancestors_by_rp_uuid[uuid] = ancestors
+    return ancestors_by_rp_uuid
@@ -131,6 +131,10 @@ class RequestGroupSearchContext(object):
         # resource class.
         self._sharing_providers = sharing
 
+        # a set of resource provider IDs that have any of the forbidden
+        # traits, looked up when first needed.
+        self._rps_with_forbidden_traits = None
+
         # bool indicating there is some level of nesting in the environment
         self.has_trees = has_trees
 
@@ -143,6 +147,24 @@ class RequestGroupSearchContext(object):
         # NOTE: This could be refactored to see the requested resources
         return bool(self._sharing_providers)
 
+    @property
+    def sharing_providers(self):
+        """A set of resource provider IDs that share some inventory for some
+        resource class.
+        """
+        return self._sharing_providers
+
+    @property
+    def rps_with_forbidden_traits(self):
+        """A set of resource provider IDs that have any of the forbidden
+        traits of the request group.
+        """
+        if self._rps_with_forbidden_traits is None:
+            self._rps_with_forbidden_traits = (
+                get_provider_ids_having_any_trait(
+                    self.context, self.forbidden_trait_map))
+        return self._rps_with_forbidden_traits
+
     @property
     def exists_nested(self):
         """bool indicating there is some level of nesting in the environment
@@ -154,7 +176,9 @@ class RequestGroupSearchContext(object):
     def get_rps_with_shared_capacity(self, rc_id):
         sharing_in_aggs = self._sharing_providers
         if self.rps_in_aggs:
-            sharing_in_aggs &= self.rps_in_aggs
+            # NOTE: Don't update the set in place; it is shared by the search
+            # contexts of all the RequestGroups in the request.
+            sharing_in_aggs = sharing_in_aggs & self.rps_in_aggs
         if not sharing_in_aggs:
             return set()
         rps_with_resource = set(p[0] for p in self._rps_with_resource[rc_id])
@@ -302,48 +326,6 @@ class RequestWideSearchContext(object):
         return alloc_request_objs, summary_objs
 
 
-def provider_ids_from_rp_ids(context, rp_ids):
-    """Given an iterable of internal resource provider IDs, returns a dict,
-    keyed by internal provider Id, of ProviderIds namedtuples describing those
-    providers.
-
-    :returns: dict, keyed by internal provider Id, of ProviderIds namedtuples
-    :param rp_ids: iterable of internal provider IDs to look up
-    """
-    # SELECT
-    #   rp.id, rp.uuid,
-    #   parent.id AS parent_id, parent.uuid AS parent_uuid,
-    #   root.id AS root_id, root.uuid AS root_uuid
-    # FROM resource_providers AS rp
-    # INNER JOIN resource_providers AS root
-    #   ON rp.root_provider_id = root.id
-    # LEFT JOIN resource_providers AS parent
-    #   ON rp.parent_provider_id = parent.id
-    # WHERE rp.id IN ($rp_ids)
-    me = sa.alias(_RP_TBL, name="me")
-    parent = sa.alias(_RP_TBL, name="parent")
-    root = sa.alias(_RP_TBL, name="root")
-    cols = [
-        me.c.id,
-        me.c.uuid,
-        parent.c.id.label('parent_id'),
-        parent.c.uuid.label('parent_uuid'),
-        root.c.id.label('root_id'),
-        root.c.uuid.label('root_uuid'),
-    ]
-    me_to_root = sa.join(me, root, me.c.root_provider_id == root.c.id)
-    me_to_parent = sa.outerjoin(
-        me_to_root, parent,
-        me.c.parent_provider_id == parent.c.id)
-    sel = sa.select(cols).select_from(me_to_parent)
-    sel = sel.where(me.c.id.in_(rp_ids))
-
-    ret = {}
-    for r in context.session.execute(sel):
-        ret[r['id']] = ProviderIds(**r)
-    return ret
-
-
 @db_api.placement_context_manager.reader
 def provider_ids_from_uuid(context, uuid):
     """Given the UUID of a resource provider, returns a namedtuple
@@ -578,6 +560,27 @@ def get_provider_ids_matching(rg_ctx):
     return [rpids for rpids in provs_with_resource if rpids[0] in filtered_rps]
 
 
+def _filter_forbidden_traits(rg_ctx, provs_with_inv_rc):
+    """Removes the providers having any of the forbidden traits of the
+    RequestGroup from a RPCandidateList.
+
+    Unlike required traits, which the providers in a tree (including sharing
+    providers) may have collectively, a forbidden trait disqualifies the very
+    provider having it. So get those providers out of the way before their
+    combinations are enumerated in _alloc_candidates_multiple_providers().
+
+    :param rg_ctx: RequestGroupSearchContext
+    :param provs_with_inv_rc: RPCandidateList to filter in place
+    """
+    if not rg_ctx.forbidden_trait_map:
+        return
+    provs_with_inv_rc.filter_out_rps(rg_ctx.rps_with_forbidden_traits)
+    LOG.debug("found %d providers under %d trees after applying "
+              "forbidden traits filter %s",
+              len(provs_with_inv_rc.rps), len(provs_with_inv_rc.trees),
+              list(rg_ctx.forbidden_trait_map))
+
+
 @db_api.placement_context_manager.reader
 def get_trees_matching_all(rg_ctx, rw_ctx):
     """Returns a RPCandidates object representing the providers that satisfy
@@ -685,6 +688,10 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
             if not provs_with_inv_rc:
                 # Short-circuit returning an empty RPCandidateList
                 return rp_candidates.RPCandidateList()
+        _filter_forbidden_traits(rg_ctx, provs_with_inv_rc)
+        if not provs_with_inv_rc:
+            # Short-circuit returning an empty RPCandidateList
+            return rp_candidates.RPCandidateList()
 
         # Adding the resource providers we've got for this resource class,
         # filter provs_with_inv to have only trees with enough inventories
@@ -698,27 +705,25 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
         if not provs_with_inv:
             return rp_candidates.RPCandidateList()
 
-    if (not rg_ctx.required_trait_map and not rg_ctx.forbidden_trait_map) or (
-            rg_ctx.exists_sharing):
+    if not rg_ctx.required_trait_map or rg_ctx.exists_sharing:
         # If there were no traits required, there's no difference in how we
         # calculate allocation requests between nested and non-nested
         # environments, so just short-circuit and return. Or if sharing
-        # providers are in play, we check the trait constraints later
-        # in _alloc_candidates_multiple_providers(), so skip.
+        # providers are in play, we check the required traits later
+        # in _alloc_candidates_multiple_providers(), so skip. Providers having
+        # forbidden traits have already been filtered out above.
         return provs_with_inv
 
     # Return the providers where the providers have the available inventory
     # capacity and that set of providers (grouped by their tree) have all
-    # of the required traits and none of the forbidden traits
+    # of the required traits
     rp_tuples_with_trait = _get_trees_with_traits(
-        rg_ctx.context, provs_with_inv.rps, rg_ctx.required_trait_map,
-        rg_ctx.forbidden_trait_map)
+        rg_ctx.context, provs_with_inv.rps, rg_ctx.required_trait_map, None)
     provs_with_inv.filter_by_rp(rp_tuples_with_trait)
     LOG.debug("found %d providers under %d trees after applying "
-              "traits filter - required: %s, forbidden: %s",
+              "required traits filter %s",
               len(provs_with_inv.rps), len(provs_with_inv.trees),
-              list(rg_ctx.required_trait_map),
-              list(rg_ctx.forbidden_trait_map))
+              list(rg_ctx.required_trait_map))
 
     return provs_with_inv
 
@@ -70,6 +70,12 @@ class RPCandidateList(object):
         self.rp_candidates = set(
             p for p in self.rp_candidates if (p.id, p.root_id) in rptuples)
 
+    def filter_out_rps(self, rp_ids):
+        """Filter the candidates out if itself is in given resource providers
+        """
+        self.rp_candidates = set(
+            p for p in self.rp_candidates if p.id not in rp_ids)
+
     def filter_by_rp_or_tree(self, rp_ids):
         """Filter the candidates out if neither itself nor its root is in
         given resource providers
@@ -617,7 +617,8 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again, for each combination of providers, in
+        # _product_with_traits().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in get_trees_matching_all() function for optimization.
         # provider_names = ['cn3', 'cn3_numa1_pf1']
@@ -647,7 +648,8 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again, for each combination of providers, in
+        # _product_with_traits().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in get_trees_matching_all() function for optimization.
         # provider_names = ['cn3', 'cn3_numa1_pf1']
@@ -656,6 +658,17 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
                   required_traits=req_traits,
                   forbidden_traits=forbidden_traits)
 
+        # Providers having a forbidden trait are excluded by themselves. Since
+        # cn3 provides VCPU and MEMORY_MB but has the GENEVE trait, the whole
+        # cn3 tree can't satisfy the request if we forbid that trait
+        forbidden_traits = {
+            geneve_t.name: geneve_t.id,
+        }
+        expected_trees = ['cn1']
+        expected_rps = ['cn1', 'cn1_numa0_pf0', 'cn1_numa1_pf1']
+        _run_test(expected_trees, expected_rps,
+                  forbidden_traits=forbidden_traits)
+
         # Consume all the VFs in first and third compute nodes and verify
         # no more providers are returned
         cn1_pf0 = rp_obj.ResourceProvider.get_by_uuid(self.ctx,
@@ -1226,6 +1239,25 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         ]
         self._validate_allocation_requests(expected, alloc_cands)
 
+    def test_fractional_allocation_ratio(self):
+        # The capacity is (total - reserved) * allocation_ratio rounded down
+        # as Inventory.capacity does, even where allocation_ratio can't be
+        # exactly represented as a float.
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 100, allocation_ratio=0.9)
+
+        alloc_cands = self._get_allocation_candidates(
+            {'': placement_lib.RequestGroup(
+                use_same_provider=False,
+                resources={orc.VCPU: 1})})
+
+        expected = {
+            'cn1': set([
+                (orc.VCPU, 90, 0),
+            ]),
+        }
+        self._validate_provider_summary_resources(expected, alloc_cands)
+
     def test_all_local_limit(self):
         """Create some resource providers that can satisfy the request for
         resources with local (non-shared) resources, limit them, and verify
@@ -1134,6 +1134,34 @@ class SharedProviderTestCase(tb.PlacementDbBaseTestCase):
         rps_sharing_dist = rg_ctx.get_rps_with_shared_capacity(DISK_GB_ID)
         self.assertEqual(set([ss1.id]), rps_sharing_dist)
 
+    def test_shared_capacity_leaves_sharing_providers_unchanged(self):
+        """The set of sharing providers is shared by the search contexts of
+        all the request groups, so filtering it by the member_of aggregates
+        of one group must not modify it.
+        """
+        cn1 = self._create_provider('cn1', uuidsentinel.agg1)
+        tb.add_inventory(cn1, orc.VCPU, 24)
+        ss1 = self._create_provider('shared storage 1', uuidsentinel.agg1)
+        ss2 = self._create_provider('shared storage 2', uuidsentinel.agg2)
+        for ss in (ss1, ss2):
+            tb.add_inventory(ss, orc.DISK_GB, 2000)
+            tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+
+        request = placement_lib.RequestGroup(
+            use_same_provider=False,
+            resources={orc.VCPU: 2, orc.DISK_GB: 100},
+            member_of=[[uuidsentinel.agg1]])
+        has_trees = res_ctx._has_provider_trees(self.ctx)
+        sharing = res_ctx.get_sharing_providers(self.ctx)
+        rg_ctx = res_ctx.RequestGroupSearchContext(
+            self.ctx, request, has_trees, sharing)
+
+        DISK_GB_ID = orc.STANDARDS.index(orc.DISK_GB)
+        for _ in range(2):
+            self.assertEqual(
+                set([ss1.id]), rg_ctx.get_rps_with_shared_capacity(DISK_GB_ID))
+            self.assertEqual(set([ss1.id, ss2.id]), sharing)
+
 
 # We don't want to waste time sleeping in these tests. It would add
 # tens of seconds.
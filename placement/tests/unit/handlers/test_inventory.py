@@ -0,0 +1,63 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for the inventory handler helpers."""
+
+import microversion_parse
+from oslo_utils.fixture import uuidsentinel
+import testtools
+
+from placement import exception
+from placement.handlers import inventory
+from placement import microversion
+from placement.objects import inventory as inv_obj
+from placement.objects import resource_provider as rp_obj
+
+
+class TestValidateInventoryCapacity(testtools.TestCase):
+
+    def setUp(self):
+        super(TestValidateInventoryCapacity, self).setUp()
+        self.rp = rp_obj.ResourceProvider(None, uuid=uuidsentinel.rp)
+
+    @staticmethod
+    def _version(minor):
+        version = microversion_parse.Version(1, minor)
+        version.max_version = microversion_parse.parse_version_string(
+            microversion.max_version_string())
+        version.min_version = microversion_parse.parse_version_string(
+            microversion.min_version_string())
+        return version
+
+    def _inventory(self, reserved):
+        return inv_obj.Inventory(
+            resource_provider=self.rp, resource_class='DISK_GB', total=10,
+            reserved=reserved)
+
+    def test_before_1_26(self):
+        version = self._version(25)
+        inventory._validate_inventory_capacity(version, self._inventory(9))
+        exc = self.assertRaises(
+            exception.InvalidInventoryCapacity,
+            inventory._validate_inventory_capacity, version,
+            [self._inventory(0), self._inventory(10)])
+        self.assertIn('The reserved value is greater than or equal to total.',
+                      exc.format_message())
+
+    def test_1_26(self):
+        version = self._version(26)
+        inventory._validate_inventory_capacity(version, self._inventory(10))
+        exc = self.assertRaises(
+            exception.InvalidInventoryCapacity,
+            inventory._validate_inventory_capacity, version,
+            [self._inventory(0), self._inventory(11)])
+        self.assertIn('The reserved value is greater than total.',
+                      exc.format_message())
@@ -82,6 +82,10 @@ class TestAllocationCandidatesNoDB(base.TestCase):
             set(["000"])
         ]
 
+        ancestors_by_rp = ac_obj._get_ancestors_by_rp_uuid(parent_by_rp)
+        self.assertEqual(set(["0"]), ancestors_by_rp["0"])
+        self.assertEqual(set(["0", "01", "011"]), ancestors_by_rp["011"])
+
         different_subtree = [
             set(["10", "11"]),
             set(["110", "111"]),
@@ -92,8 +96,80 @@ class TestAllocationCandidatesNoDB(base.TestCase):
 
         for group in same_subtree:
             self.assertTrue(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, ancestors_by_rp))
 
         for group in different_subtree:
             self.assertFalse(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, ancestors_by_rp))
+
+    def test_product_with_traits(self):
+        # Provider 1 has both of the required traits, 2 only FOO, 3 only BAR
+        # and 4 none of them.
+        trait_bits = {'CUSTOM_FOO': 1, 'CUSTOM_BAR': 2}
+        bits_by_rp = {1: 3, 2: 1, 3: 2, 4: 0}
+
+        def _arr(rp_id):
+            return mock.Mock(resource_provider=mock.Mock(id=rp_id))
+
+        arrs = dict((rp_id, _arr(rp_id)) for rp_id in bits_by_rp)
+        request_groups = [[arrs[1], arrs[2], arrs[4]], [arrs[3], arrs[4]]]
+
+        result = list(ac_obj._product_with_traits(
+            request_groups, bits_by_rp, trait_bits))
+        # The combinations are ordered like request_groups, even though the
+        # shorter second list is picked from first.
+        expected = [(arrs[1], arrs[3]), (arrs[1], arrs[4]),
+                    (arrs[2], arrs[3])]
+        self.assertEqual(3, len(result))
+        self.assertEqual(set(expected), set(result))
+
+        # Without required traits we get the whole product
+        result = list(ac_obj._product_with_traits(
+            request_groups, bits_by_rp, {}))
+        self.assertEqual(6, len(result))
+
+        # No combination can have a trait none of the providers has
+        trait_bits = {'CUSTOM_FOO': 1, 'CUSTOM_BAR': 2, 'CUSTOM_BAZ': 4}
+        result = list(ac_obj._product_with_traits(
+            request_groups, bits_by_rp, trait_bits))
+        self.assertEqual([], result)
+
+    def test_product_with_policies(self):
+        # Providers 1 and 2 have 4 VCPU each, of which 1 is used.
+        rps = dict((rp_id, mock.Mock(uuid=rp_id)) for rp_id in (1, 2))
+        psum_res_by_rp_rc = dict(
+            ((rp_id, 'VCPU'), mock.Mock(used=1, capacity=4, max_unit=4))
+            for rp_id in rps)
+
+        def _areq(suffix, rp_id, amount):
+            arr = ac_obj.AllocationRequestResource(
+                resource_provider=rps[rp_id], resource_class='VCPU',
+                amount=amount)
+            return ac_obj.AllocationRequest(
+                use_same_provider=True, resource_requests=[arr],
+                mappings={suffix: set([rp_id])})
+
+        areq_lists_by_suffix = {
+            '1': [_areq('1', 1, 2), _areq('1', 2, 2)],
+            '2': [_areq('2', 1, 1), _areq('2', 2, 2)],
+        }
+        rw_ctx = mock.Mock(group_policy='none', same_subtrees=[])
+
+        # Picking 2 VCPU from a provider twice exceeds its capacity.
+        result = list(ac_obj._product_with_policies(
+            areq_lists_by_suffix, rw_ctx, {}, psum_res_by_rp_rc))
+        self.assertEqual(3, len(result))
+        self.assertNotIn(
+            (areq_lists_by_suffix['1'][1], areq_lists_by_suffix['2'][1]),
+            result)
+
+        # Each granular group has to be satisfied by its own provider.
+        rw_ctx.group_policy = 'isolate'
+        result = list(ac_obj._product_with_policies(
+            areq_lists_by_suffix, rw_ctx, {}, psum_res_by_rp_rc))
+        expected = [
+            (areq_lists_by_suffix['1'][0], areq_lists_by_suffix['2'][1]),
+            (areq_lists_by_suffix['1'][1], areq_lists_by_suffix['2'][0]),
+        ]
+        self.assertEqual(2, len(result))
+        self.assertEqual(set(expected), set(result))
@@ -52,6 +52,14 @@ class TestRPCandidateList(testtools.TestCase):
         expected_rpsinfo = set([('ss1', 'root1', 'rc_1')])
         self.assertEqual(expected_rpsinfo, self.rp_candidates.rps_info)
 
+    def test_filter_out_rps(self):
+        self.rp_candidates.filter_out_rps(set(['ss1', 'root1']))
+        # 'ss1' is excluded, but rps under 'root1' are not
+        expected_rpsinfo = set([('rp1', 'root1', 'rc_1'),
+                                ('rp2', 'root1', 'rc_1'),
+                                ('rp3', 'root', 'rc_1')])
+        self.assertEqual(expected_rpsinfo, self.rp_candidates.rps_info)
+
     def test_filter_by_rp_or_tree(self):
         self.rp_candidates.filter_by_rp_or_tree(set(['ss1', 'root1']))
         # we get 'ss1' and rps under 'root1'
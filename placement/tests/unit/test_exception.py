@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the placement exception messages."""
+
+import pickle
+
+import mock
+import testtools
+
+from placement import exception
+
+
+class TestBaseException(testtools.TestCase):
+
+    def test_no_format_args(self):
+        exc = exception.ResourceProviderNotFound()
+        self.assertFalse(exc._has_fmt_args)
+        self.assertEqual('No results are possible.', exc.format_message())
+        self.assertEqual('No results are possible.', str(exc))
+
+    def test_format_args(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        self.assertTrue(exc._has_fmt_args)
+        self.assertEqual('No such resource class CUSTOM_FOO.',
+                         exc.format_message())
+        self.assertEqual({'resource_class': 'CUSTOM_FOO'}, exc.kwargs)
+
+    def test_explicit_message(self):
+        exc = exception.ResourceClassNotFound('custom message',
+                                              resource_class='CUSTOM_FOO')
+        self.assertEqual('custom message', exc.format_message())
+
+    def test_subclass_computes_fmt_args(self):
+        class NoArgs(exception.InvalidInventory):
+            msg_fmt = 'Nothing to format.'
+
+        class Escaped(exception.NotFound):
+            msg_fmt = '100%% not found.'
+
+        self.assertFalse(NoArgs._has_fmt_args)
+        self.assertEqual('Nothing to format.', NoArgs().format_message())
+        self.assertTrue(Escaped._has_fmt_args)
+        self.assertEqual('100% not found.', Escaped().format_message())
+
+    def test_missing_format_args(self):
+        # The mismatch is logged when the exception is created.
+        with mock.patch.object(exception.LOG, 'error') as mock_log:
+            exc = exception.ResourceClassNotFound(name='CUSTOM_FOO')
+        mock_log.assert_called_once_with(
+            'Exception in string format operation for %s, kwargs: %s',
+            'ResourceClassNotFound', {'name': 'CUSTOM_FOO'})
+        self.assertEqual(frozenset(['resource_class']), exc._fmt_keys)
+        self.assertEqual(exception.ResourceClassNotFound.msg_fmt,
+                         exc.format_message())
+
+    def test_message_is_rendered_lazily(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        self.assertIsNone(exc._message)
+        self.assertEqual('No such resource class CUSTOM_FOO.', str(exc))
+        self.assertEqual('No such resource class CUSTOM_FOO.', exc._message)
+        self.assertEqual('No such resource class CUSTOM_FOO.', exc.message)
+
+    def test_pickle(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        new_exc = pickle.loads(pickle.dumps(exc))
+        self.assertIsInstance(new_exc, exception.ResourceClassNotFound)
+        self.assertEqual({'resource_class': 'CUSTOM_FOO'}, new_exc.kwargs)
+        self.assertEqual('No such resource class CUSTOM_FOO.', str(new_exc))
+
+    def test_pickle_does_not_log(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        exc.args = ('foo', 'bar')
+        with mock.patch.object(exception.LOG, 'error') as mock_log:
+            new_exc = pickle.loads(pickle.dumps(exc))
+        mock_log.assert_not_called()
+        self.assertEqual(('foo', 'bar'), new_exc.args)
+        self.assertEqual('No such resource class CUSTOM_FOO.', str(new_exc))
+
+    def test_empty_message(self):
+        exc = exception.ResourceClassNotFound('', resource_class='CUSTOM_FOO')
+        self.assertEqual('No such resource class CUSTOM_FOO.',
+                         exc.format_message())
+
+    def test_bad_format_value(self):
+        class BadValue(exception.NotFound):
+            msg_fmt = 'Found %(count)d things.'
+
+        exc = BadValue(count='many')
+        with mock.patch.object(exception.LOG, 'error') as mock_log:
+            self.assertEqual(BadValue.msg_fmt, exc.format_message())
+        mock_log.assert_called_once_with(
+            'Exception in string format operation for %s, kwargs: %s',
+            'BadValue', {'count': 'many'})
+
+    def test_args_set_verbatim(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        exc.args = ('foo', 'bar')
+        self.assertEqual(('foo', 'bar'), exc.args)
+        self.assertEqual("ResourceClassNotFound('foo', 'bar')", repr(exc))
+        self.assertEqual('No such resource class CUSTOM_FOO.', str(exc))
+        exc.args = ()
+        self.assertEqual(('No such resource class CUSTOM_FOO.',), exc.args)
+
+    def test_args_and_repr(self):
+        exc = exception.ResourceClassNotFound(resource_class='CUSTOM_FOO')
+        self.assertEqual(('No such resource class CUSTOM_FOO.',), exc.args)
+        self.assertEqual(
+            "ResourceClassNotFound('No such resource class CUSTOM_FOO.')",
+            repr(exc))
+
+    def test_invalid_inventory_capacity_default_comparison(self):
+        with mock.patch.object(exception.LOG, 'error') as mock_log:
+            exc = exception.InvalidInventoryCapacity(
+                resource_class='DISK_GB', resource_provider='rp')
+        mock_log.assert_not_called()
+        self.assertEqual(
+            "Invalid inventory for 'DISK_GB' on resource provider 'rp'. "
+            "The reserved value is greater than or equal to total.",
+            exc.format_message())